@@ -26,43 +26,83 @@ SOFTWARE.
 
 import argparse
 import asyncio
-from asyncio.tasks import sleep
+import contextlib
 import datetime
 import json
-import uuid
+import os
+import socket
 import sys
+import tempfile
+
+# json_dumps always produces bytes, ready to be sent or written
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+STATUS_PENDING = 0
+STATUS_IN_WORK = 1
+STATUS_DONE = 2
+STATUS_FAILED = 3
+STATUS_CLEARED = 4
+
+# statuses that are written to the journal; a job in one of these never runs again
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CLEARED)
 
-KEY_PENDING = "pending"
-KEY_IN_WORK = "in_work"
 KEY_DONE = "done"
 KEY_FAILED = "failed"
 
 JSON_NEXT = "next"
 JSON_COMM = "command"
 JSON_MESS = "reason"
+JSON_WANT = "want"
+JSON_BATCH = "batch"
+JSON_RESULTS = "results"
 
 JSON_STDOUT = "stdout"
 JSON_STDERR = "stderr"
 
-BLANK = json.dumps({}).encode()
+JOURNAL_ID = "id"
+JOURNAL_COMM = "command"
+JOURNAL_STATUS = "status"
 
+HEADER_SIZE = 4
 
-class Node:
-    '''
-    A class to represent a job node.
+STREAM_LIMIT = 1 << 20
 
-    Attributes
-    ----------
-    command : str
-        command to execute
-    status : str
-        string representation of status (one of KEY_*)
+LOAD_REPORT_EVERY = 100000
+
+TAIL_SIZE = 4096
+
+
+async def read_msg(reader):
+    '''Read one length-prefixed message from a stream'''
+    header = await reader.readexactly(HEADER_SIZE)
+    size = int.from_bytes(header, "big")
+    return await reader.readexactly(size)
+
+
+def tune_socket(writer):
     '''
+    Disable Nagle on a stream, so small messages go out immediately, and let
+    large messages be buffered without waiting on drain
+    '''
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    writer.transport.set_write_buffer_limits(high=STREAM_LIMIT)
+
 
-    def __init__(self, command) -> None:
-        '''Constructor, takes a command string to store'''
-        self.command = command
-        self.status = KEY_PENDING
+async def write_msg(writer, payload):
+    '''Write one length-prefixed message to a stream'''
+    writer.writelines((len(payload).to_bytes(HEADER_SIZE, "big"), payload))
+    await writer.drain()
 
 
 class APrompt:
@@ -75,17 +115,31 @@ class APrompt:
         hosting event loop
     queue : asyncio.Queue
         text queue from stdin
+    enabled : bool
+        whether stdin is an interactive terminal we are reading from
     '''
 
     def __init__(self) -> None:
         self.loop = asyncio.get_event_loop()
         self.queue = asyncio.Queue()
-        self.loop.add_reader(sys.stdin, self.on_input)
+        self.enabled = sys.stdin.isatty()
+        if self.enabled:
+            self.loop.add_reader(sys.stdin, self.on_input)
 
     def on_input(self):
         '''Used to extract text from stdin and place in a queue'''
-        asyncio.ensure_future(self.queue.put(
-            sys.stdin.readline()), loop=self.loop)
+        line = sys.stdin.readline()
+        if not line:
+            # end of input, stop watching stdin
+            self.close()
+            return
+        self.queue.put_nowait(line)
+
+    def close(self):
+        '''Stop reading from stdin'''
+        if self.enabled:
+            self.loop.remove_reader(sys.stdin)
+            self.enabled = False
 
     async def __call__(self, message):
         '''Print a message and await input from the user'''
@@ -97,147 +151,309 @@ class Server:
     '''
     A class to represent a job server.
 
-    Each job is represented by a UUID key.
+    Each job is represented by an integer key, which indexes the command and
+    status lists.
 
     Attributes
     ----------
     server_start_time : datetime
         the time the server started, used for timing (in future)
-    server_command_db : map of str uuids -> Node
-        database of all jobs known to the server
-    server_command_pending_list : list of str uuids
-        list of jobs pending, to avoid having to keep scanning the db
+    server_commands : list of str
+        command to execute for every job known to the server
+    server_statuses : bytearray
+        status of every job known to the server (one of STATUS_*)
+    server_command_pending_list : asyncio.Queue of int ids
+        queue of jobs pending, to avoid having to keep scanning the db
+    outstanding : int
+        number of jobs that are either pending or in work
     server_link : an asyncio TCP server object
         reference to the server object, needed for issuing a shutdown, etc
     prompt : APrompt
         the async prompt object we use to get commands from the console    
     conn_list : set
         the set of connected clients
+    journal : file or None
+        append-only record of loaded jobs and finished jobs, if enabled
     '''
 
-    def __init__(self, opt_file) -> None:
-        '''Initialize the server object with an optional command list text file object'''
+    def __init__(self, opt_file, journal_path=None) -> None:
+        '''
+        Initialize the server object with an optional command list text file
+        object, and an optional journal file path to resume from and record to
+        '''
         self.server_start_time = datetime.datetime.now()
-        self.server_command_pending_list = []
-        self.server_command_db = {}
+        self.server_command_pending_list = asyncio.Queue()
+        self.server_commands = []
+        self.server_statuses = bytearray()
+        self.outstanding = 0
         self.server_link = None
         self.prompt = APrompt()
         self.conn_list = set()
+        self.journal = None
 
-        if opt_file is not None:
-            lines = opt_file.readlines()
+        if journal_path is not None:
+            clean = self.server_replay_journal(journal_path)
+            self.journal = open(journal_path, "ab")
+            if not clean:
+                # the last entry was cut short, so start on a fresh line
+                self.journal.write(b"\n")
 
-            self.server_load_list(lines)
+        if opt_file is not None:
+            self.server_load_list(opt_file)
 
     def setup_prompt(self):
+        if not self.prompt.enabled:
+            return
         loop = asyncio.get_event_loop()
         loop.create_task(self.run_prompt())
 
+    def server_replay_journal(self, path):
+        '''
+        Rebuild job state from a journal written by a previous run.
+
+        Jobs that were in work when that run stopped are pending again.
+        Entries that are damaged, out of order, or name an unknown job are
+        skipped. Returns False if the journal ends with an incomplete entry.
+        '''
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return True
+
+        clean = True
+        with f:
+            for line in f:
+                clean = line.endswith(b"\n")
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    print("Skipping damaged journal entry")
+                    continue
+
+                if not isinstance(entry, dict):
+                    print("Skipping damaged journal entry")
+                    continue
+
+                # bool is a subclass of int, so check the exact type
+                id = entry.get(JOURNAL_ID)
+                if type(id) is not int:
+                    print("Skipping damaged journal entry")
+                    continue
+
+                if JOURNAL_COMM in entry:
+                    # a load entry must be the next job; anything else means
+                    # earlier entries were lost, and would shift every job
+                    if id != len(self.server_commands) or \
+                            not isinstance(entry[JOURNAL_COMM], str):
+                        print(f"Skipping out of order journal entry for job {id}")
+                        continue
+                    self.server_commands.append(entry[JOURNAL_COMM])
+                    self.server_statuses.append(STATUS_PENDING)
+                elif not 0 <= id < len(self.server_commands):
+                    print(f"Skipping journal entry for unknown job {id}")
+                elif type(entry.get(JOURNAL_STATUS)) is not int or \
+                        entry[JOURNAL_STATUS] not in FINISHED_STATUSES:
+                    print("Skipping damaged journal entry")
+                else:
+                    self.server_statuses[id] = entry[JOURNAL_STATUS]
+
+        for id, status in enumerate(self.server_statuses):
+            if status == STATUS_PENDING:
+                self.server_command_pending_list.put_nowait(id)
+                self.outstanding += 1
+
+        print("Resumed {} commands, {} left".format(
+            len(self.server_commands), self.outstanding))
+
+        return clean
+
+    def server_journal(self, entry, flush=True):
+        '''Append an entry to the journal, if there is one'''
+        if self.journal is None:
+            return
+        self.journal.write(json_dumps(entry) + b"\n")
+        if flush:
+            self.journal.flush()
+
     def server_load_list(self, lines):
-        '''Add lines of commands to the database and to the pending list'''
+        '''
+        Add lines of commands to the database and to the pending list.
+
+        Lines can be any iterable, such as an open file, which is read lazily.
+        Nothing is added unless every line can be read.
+        '''
         self.server_start_time = datetime.datetime.now()
-        print("Loading {} commands...".format(len(lines)))
+        print("Loading commands...")
 
+        # read everything first, so a bad line part way through can't leave
+        # a half loaded file behind
+        staged = []
         for line in lines:
-            next = str(uuid.uuid4())
-            self.server_command_pending_list.append(next)
-            self.server_command_db[next] = Node(line.strip())
+            staged.append(line.strip())
+
+            if len(staged) % LOAD_REPORT_EVERY == 0:
+                print("Read {} commands...".format(len(staged)))
+
+        for command in staged:
+            next_id = len(self.server_commands)
+            self.server_commands.append(command)
+            self.server_statuses.append(STATUS_PENDING)
+            self.server_command_pending_list.put_nowait(next_id)
+            self.outstanding += 1
+
+            self.server_journal({JOURNAL_ID: next_id, JOURNAL_COMM: command},
+                                flush=False)
 
-    async def server_get_next(self):
+        if self.journal is not None:
+            self.journal.flush()
+
+        print("Loaded {} commands".format(len(staged)))
+
+    async def server_get_next(self, want):
         '''
-        Get the next command to issue to clients.
+        Get a batch of up to want commands to issue to clients.
 
-        If there is none, sleep for 5 seconds and check again
+        If there is none, wait until more are added
         '''
-        while True:
-            # print("Getting next task...")
-            if not len(self.server_command_pending_list):
-                await asyncio.sleep(5)
-                continue
-            id = self.server_command_pending_list.pop()
-            assert(self.server_command_db[id].status == KEY_PENDING)
-            self.server_command_db[id].status = KEY_IN_WORK
-            to_send = {JSON_NEXT: id,
-                       JSON_COMM: self.server_command_db[id].command}
-            return json.dumps(to_send), id
+        ids = [await self.server_command_pending_list.get()]
+
+        while len(ids) < want and not self.server_command_pending_list.empty():
+            ids.append(self.server_command_pending_list.get_nowait())
+
+        batch = []
+        for id in ids:
+            assert(self.server_statuses[id] == STATUS_PENDING)
+            self.server_statuses[id] = STATUS_IN_WORK
+            batch.append({JSON_NEXT: id,
+                          JSON_COMM: self.server_commands[id]})
+        return json_dumps({JSON_BATCH: batch}), ids
 
     def server_handle_incoming(self, b):
-        '''Handle returning data from the client; start, success, fail'''
+        '''
+        Handle returning data from the client; start, success, fail
+
+        Returns the number of jobs the client wants next
+        '''
         try:
-            read_obj = json.loads(b)
-        except:
+            read_obj = json_loads(b)
+        except ValueError:
             print("Unable to parse json!")
-            return
+            return 1
 
-        if not len(read_obj):
-            # skip blank objects, as they are used by a client to ask for a new job
+        if not isinstance(read_obj, dict):
+            print("Got a message that is not an object!")
+            return 1
+
+        results = read_obj.get(JSON_RESULTS, [])
+        if not isinstance(results, list):
+            print("Got results that are not a list!")
+            results = []
+
+        for result in results:
+            self.server_handle_result(result)
+
+        want = read_obj.get(JSON_WANT, 1)
+        if type(want) is not int or want < 1:
+            want = 1
+        return want
+
+    def server_handle_result(self, read_obj):
+        '''Handle the result of a single job'''
+        if not isinstance(read_obj, dict):
+            print("Got a result that is not an object!")
             return
 
         if KEY_DONE in read_obj:
             key = read_obj[KEY_DONE]
-            r = KEY_DONE
-
-        if KEY_FAILED in read_obj:
+            r = STATUS_DONE
+        elif KEY_FAILED in read_obj:
             key = read_obj[KEY_FAILED]
-            r = KEY_FAILED
+            r = STATUS_FAILED
 
             print(f"Job {key} failed!")
 
             try:
-                fail_o = json.loads(read_obj[JSON_MESS])
+                fail_o = read_obj[JSON_MESS]
                 print(f"stdout: {fail_o[JSON_STDOUT]}")
                 print(f"stderr: {fail_o[JSON_STDERR]}")
-            except:
+            except (KeyError, TypeError):
                 pass
+        else:
+            print("Got a result without a status!")
+            return
 
-        if key not in self.server_command_db:
+        # bool is a subclass of int, so true/false must not pass as job ids
+        if type(key) is not int or not 0 <= key < len(self.server_commands):
             print("Got a 'done' for a job we aren't in control of!")
             return
 
-        assert(self.server_command_db[key].status == KEY_IN_WORK)
-        self.server_command_db[key].status = r
+        if self.server_statuses[key] != STATUS_IN_WORK:
+            print(f"Got a result for job {key}, which is not in work!")
+            return
+
+        self.server_statuses[key] = r
+        self.outstanding -= 1
+
+        self.server_journal({JOURNAL_ID: key, JOURNAL_STATUS: r})
 
     async def server_cb(self, reader, writer):
         '''Created as a new task whenever a new client connects'''
-        assigned = None
+        assigned = []
 
         peer = writer.get_extra_info("peername")
 
+        tune_socket(writer)
+
         self.conn_list.add(peer)
 
-        while True:
-            data = await reader.read(2048)
-            data = data.decode()
+        try:
+            while True:
+                data = await read_msg(reader)
 
-            self.server_handle_incoming(data)
+                want = self.server_handle_incoming(data)
 
-            to_send, assigned = await self.server_get_next()
+                to_send, assigned = await self.server_get_next(want)
 
-            writer.write(to_send.encode())
-            await writer.drain()
+                await write_msg(writer, to_send)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.server_requeue(assigned)
+            self.conn_list.discard(peer)
 
-        self.conn_list.discard(peer)
+    def server_requeue(self, ids):
+        '''Put jobs that a lost client never finished back on the pending list'''
+        for id in ids:
+            if self.server_statuses[id] == STATUS_IN_WORK:
+                print(f"Job {id} was not finished, queuing it again")
+                self.server_statuses[id] = STATUS_PENDING
+                self.server_command_pending_list.put_nowait(id)
 
     async def c_progress(self, l):
         '''User is asking for progress info'''
-        to_do = [k for k, v in self.server_command_db.iter() if v.status ==
-                 KEY_IN_WORK or v.status == KEY_PENDING]
-
-        prs = "{} left".format(len(to_do))
+        prs = "{} left".format(self.outstanding)
         print("Progress: ", prs)
 
     async def c_add(self, l):
         '''User is asking to add a new file containing commands'''
         try:
             with open(l[0]) as f:
-                lines = f.readlines()
-                self.server_load_list(lines)
-        except:
-            print("Unable to load file")
+                self.server_load_list(f)
+        except (IndexError, OSError, ValueError) as e:
+            print("Unable to load file:", e)
 
     async def c_clear(self, l):
         '''User wants to clear all pending jobs'''
-        self.server_command_pending_list.clear()
+        while not self.server_command_pending_list.empty():
+            id = self.server_command_pending_list.get_nowait()
+            self.server_statuses[id] = STATUS_CLEARED
+            self.outstanding -= 1
+
+            self.server_journal({JOURNAL_ID: id, JOURNAL_STATUS: STATUS_CLEARED},
+                                flush=False)
+
+        if self.journal is not None:
+            self.journal.flush()
 
     async def c_who(self, l):
         '''User wants a list of all connected clients'''
@@ -272,15 +488,17 @@ class Server:
 
             try:
                 await prompt_decode[k](parts[1:])
-            except:
-                pass
+            except Exception as e:
+                print("Command failed:", e)
 
 
-async def as_server(command_file, port):
+async def as_server(command_file, port, journal_path, reuse_port):
     '''Run as a server, creating server state and loops'''
-    job_server = Server(command_file)
+    job_server = Server(command_file, journal_path)
 
-    server = await asyncio.start_server(job_server.server_cb, port=port)
+    server = await asyncio.start_server(job_server.server_cb, port=port,
+                                        limit=STREAM_LIMIT,
+                                        reuse_port=reuse_port)
 
     job_server.server_link = server
 
@@ -293,51 +511,89 @@ async def as_server(command_file, port):
             await server.serve_forever()
     except asyncio.exceptions.CancelledError:
         print("Closing down...")
+    finally:
+        job_server.prompt.close()
+
+
+def open_log(logdir, id, ext):
+    '''Open a file to hold job output; a throwaway file if no log dir is given'''
+    if logdir is None:
+        return tempfile.TemporaryFile()
+    return open(os.path.join(logdir, f"{id}.{ext}"), "w+b")
+
+
+def read_tail(f):
+    '''Read the last TAIL_SIZE bytes of a file as text'''
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - TAIL_SIZE))
+    return f.read().decode("utf-8", "replace")
 
 
-async def client_do_work(c, id):
+async def client_do_work(c, id, logdir, limit):
     '''Handle a new job command, creating a subprocess, etc...'''
     print("Got job: ", id)
-    print("Running command: ", c)
-    proc = await asyncio.create_subprocess_shell(c, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
 
-    stdout, stderr = await proc.communicate()
+    async with limit:
+        print("Running command: ", c)
+
+        with contextlib.ExitStack() as stack:
+            try:
+                out_f = stack.enter_context(open_log(logdir, id, "out"))
+                err_f = stack.enter_context(open_log(logdir, id, "err"))
+            except OSError as e:
+                print("Unable to open log file: ", e)
+                return {KEY_FAILED: id,
+                        JSON_MESS: {JSON_STDOUT: "", JSON_STDERR: str(e)}}
+
+            # the subprocess writes straight to the files, so output is never
+            # buffered in this process
+            proc = await asyncio.create_subprocess_shell(c, stdout=out_f, stderr=err_f)
+
+            await proc.wait()
+
+            print("Done: ", proc.returncode)
 
-    print("Done: ", proc.returncode)
+            ret = {}
 
-    ret = {}
-    ret[JSON_MESS] = json.dumps(
-        {JSON_STDOUT: str(stdout), JSON_STDERR: str(stderr)})
+            if proc.returncode != 0:
+                ret[JSON_MESS] = {JSON_STDOUT: read_tail(out_f),
+                                  JSON_STDERR: read_tail(err_f)}
 
     rcode = KEY_DONE if proc.returncode == 0 else KEY_FAILED
 
     ret[rcode] = id
 
-    return json.dumps(ret)
+    return ret
 
 
-async def as_client(serveraddy, port):
+async def as_client(serveraddy, port, jobs, logdir):
     '''Run as a client, creating state and loops'''
-    reader, writer = await asyncio.open_connection(serveraddy, port)
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
 
-    writer.write(BLANK)
-    await writer.drain()
+    # never run more than jobs subprocesses at once, whatever the server sends
+    limit = asyncio.Semaphore(jobs)
+
+    reader, writer = await asyncio.open_connection(serveraddy, port,
+                                                   limit=STREAM_LIMIT)
+
+    tune_socket(writer)
+
+    await write_msg(writer, json_dumps({JSON_WANT: jobs}))
 
     while True:
         try:
-            data = await reader.read(2048)
-            data = data.decode()
-            data = json.loads(data)
+            data = await read_msg(reader)
+            data = json_loads(data)
 
-            id = data[JSON_NEXT]
-            cm = data[JSON_COMM]
+            results = await asyncio.gather(
+                *[client_do_work(job[JSON_COMM], job[JSON_NEXT], logdir, limit) for job in data[JSON_BATCH]])
 
-            result = await client_do_work(cm, id)
+            to_send = {JSON_WANT: jobs, JSON_RESULTS: results}
 
-            writer.write(result.encode())
-            await writer.drain()
+            await write_msg(writer, json_dumps(to_send))
 
-        except:
+        except (ConnectionError, asyncio.IncompleteReadError):
             print("Done.")
             return
 
@@ -350,11 +606,19 @@ if __name__ == "__main__":
 
     parser.add_argument('-t', '--txtfile', metavar="FILE", type=open,
                         help='serve jobs from the given text file')
+    parser.add_argument('--journal', metavar="FILE", type=str,
+                        help='as a server, record job progress in FILE and resume from it on startup')
+    parser.add_argument('--reuse-port', action="store_true",
+                        help='as a server, allow other servers to listen on the same port')
 
     parser.add_argument('-c', '--client', metavar="ADDRESS", type=str,
                         help='act as a client, and connect to server')
     parser.add_argument('-p', '--port', metavar="PORT", type=int, default=55000,
                         help='port to use. if given as client, overrides port in provided url')
+    parser.add_argument('-j', '--jobs', metavar="COUNT", type=int, default=1,
+                        help='number of jobs to run at the same time as a client. 0 runs one per CPU')
+    parser.add_argument('-l', '--logdir', metavar="DIR", type=str,
+                        help='as a client, keep the output of each job in DIR')
 
     args = parser.parse_args()
 
@@ -362,9 +626,21 @@ if __name__ == "__main__":
         print("Unable to be server and client at the same time!")
         exit(1)
 
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    if args.client and args.logdir is not None:
+        try:
+            os.makedirs(args.logdir, exist_ok=True)
+        except OSError as e:
+            print("Unable to use log directory:", e)
+            exit(1)
+
     if args.server:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(as_server(args.txtfile, args.port))
+        asyncio.run(as_server(args.txtfile, args.port, args.journal, args.reuse_port))
 
     if args.client:
-        asyncio.run(as_client(args.client, args.port))
+        asyncio.run(as_client(args.client, args.port, args.jobs, args.logdir))